@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # Copyright (c) 2014, John Reumann, NoFutz Networks Inc., All Rights Reserved.
 #
 # Redistribution and use in source and binary forms, with or without
@@ -75,7 +75,7 @@
 # alive those connections that already exist.
 #
 # Prerequisites:
-# Network manager, iwconfig
+# Network manager, iwconfig, optionally iw and dbus-python
 #
 # Function:
 # This script is installed on a client machine and typically run periodically
@@ -98,7 +98,7 @@
 #
 # Invocation:
 #
-#        python wifi-reconnctor.py --preferred='"prefer_me","me_too"' \
+#        python3 wifi-reconnctor.py --preferred='"prefer_me","me_too"' \
 #                                  --not_preferred='"guest_one","guest_two"' \
 #                                  --signal_quality_threshold=50 \
 #                                  --signal_quality_delta_threshold=10 \
@@ -121,6 +121,12 @@
 #
 #     sudo chmod +s /sbin/iwconfig
 #     sudo chmod +s /sbin/iwlist
+#     sudo chmod +s /sbin/iw
+#
+#   Scanning only the frequencies our WLANs were seen on needs iw and the
+#   frequencies remembered in /var/cache/wifi-reconnect.json, which only
+#   root may write. Otherwise we fall back to scanning all channels with
+#   iwlist.
 #
 #   Now run this from a terminal or anything that has access to your
 #   keyring. Running in cron doesn't actually work unless you rig your
@@ -132,15 +138,31 @@
 #     --signal_quality_delta_threshold=10 --lockfile /tmp/reconnect.lock\
 #     --sleep_between_checks 180 &
 
-import csv
+import array
+import ctypes
 import datetime
+import errno
+import fcntl
 import getopt
+import json
 import os
 import re
+import select
+import shlex
+import socket
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
 import time
 
+# Optional, without it we fall back to nmcli
+try:
+    import dbus
+except ImportError:
+    dbus = None
+
 # Global flags modified by the commandline
 dry_run = False
 interface = "wlan0"
@@ -148,9 +170,15 @@ lock = False
 lockfile = None
 non_preferred_wlans = []
 preferred_wlans = []
+# Set views of the WLAN lists above for lookups, the lists keep the order
+non_preferred_wlan_set = frozenset()
+preferred_wlan_set = frozenset()
+scan_cache_ttl = 60
+scan_timeout = 20
 signal_quality_delta_threshold = .15
 signal_quality_lower_bound = .5
 signal_quality_threshold = .5
+skip_scan_quality_threshold = .75
 sleep_between_checks = 0
 unlock = False
 
@@ -159,35 +187,95 @@ IWLIST = '/sbin/iwlist'
 SCANNING_COMMAND = 'scanning'
 
 IWCONFIG = '/sbin/iwconfig'
+IW = '/sbin/iw'
 NMCLI = '/usr/bin/nmcli'
 
+NM_BUS_NAME = 'org.freedesktop.NetworkManager'
+NM_PATH = '/org/freedesktop/NetworkManager'
+NM_SETTINGS_PATH = '/org/freedesktop/NetworkManager/Settings'
+
+# Seconds we wait for NetworkManager's list of access points. We ask for
+# the list without a rescan, so the rest of the scan timeout is left for
+# scanning ourselves.
+NMCLI_LIST_TIMEOUT = 5
+
+SCAN_CACHE_FILE = '/tmp/wifi-reconnect.scan.json'
+# Frequencies on which our WLANs were seen, keyed on the ESSID, and the
+# time of the last scan of all channels
+FREQUENCY_CACHE_FILE = '/var/cache/wifi-reconnect.json'
+# Seconds after which we scan all channels again instead of the known
+# frequencies, to find WLANs that are new or changed their channel
+FULL_SCAN_INTERVAL = 600
+
+# Wireless extensions, see linux/wireless.h
+PROC_NET_WIRELESS = '/proc/net/wireless'
+SIOCGIWRANGE = 0x8B0B
+SIOCGIWESSID = 0x8B1B
+IW_ESSID_MAX_SIZE = 32
+# Room for a struct iw_range, in which max_qual.qual is the byte at
+# offset 44 since wireless extensions 16.
+IW_RANGE_BUFFER_SIZE = 2048
+IW_RANGE_MAX_QUAL_OFFSET = 44
+# cfg80211 drivers report the link quality on a 0-70 scale, which is also
+# the denominator iwconfig shows for them.
+LINK_QUALITY_MAX = 70.
+
+# Patterns for the output of iwlist version 30, keyed on the first five
+# characters of the lines they apply to. Most lines of the output are of no
+# interest to us and can be skipped by that prefix alone. The patterns are
+# applied to lines that have already been stripped of leading whitespace.
+_IWLIST_PATTERNS = {
+    'Cell ': re.compile(r'Cell\s\d+\s.+Address: [0-9ABCDEF:]+'),
+    'Frequ': re.compile(r'Frequency:\s*(?P<ghz>[\d\.]+)\s*GHz'),
+    'Quali': re.compile(r'Quality=(?P<quality_num>\d+)/'
+                        r'(?P<quality_denom>\d+)'),
+    'ESSID': re.compile(r'ESSID:\"(?P<essid_name>[^\"]+)\"'),
+}
+
+# Pattern for the output of iw scan. Every line of interest is classified
+# by a single match, the name of the outer group that matched tells which
+# kind of line it is. It is applied to lines that have already been
+# stripped of leading whitespace.
+_IW_LINE_RE = re.compile(
+    r'(?P<bss>BSS [0-9a-f:]{17})'
+    r'|(?P<frequency>freq: (?P<mhz>[\d\.]+))'
+    r'|(?P<signal>signal: -(?P<attenuation>[\d\.]+) dBm)'
+    r'|(?P<ssid>SSID: (?P<ssid_name>.+))')
+
 
 def print_help():
     """Prints usage instructions
     """
-    print "Usage: wifi-reconnector [--preferred \'<comma_separated_network"\
-        "_names>\']\n"\
-        "                        [--not_preferred \'<comma_separated_network"\
-        "_names>\']\n\n" \
-        "Each network name must be quoted in \"\" if it is longer than one "\
-        "character.\n\n"
-    print "Additional options:\n"
-    print "  --signal_quality_deleta_threshold <1-100>: difference in signal"\
-        " strength"
-    print "    percent that causes a switch between networks in the"\
-        " same preference class\n"
-    print "  --signal_quality_threshold <1-100>: minimal signal"\
-        " strength percent that"
-    print "    causes us disassociate from a network\n" 
-    print "  --interface <ifname>: which interface is wlan (default wlan0)\n"
-    print "  --dry_run:  don't do anything just dump what would be done.\n"
-    print "  --sleep_between_checks: seconds between checks, unset or 0 to"\
-          " exit immediately."
-    print "  --lockfile: path to lockfile. A path starting with \'/\' is"
-    print "    absolute, without it is concatenated after $HOME\n"
-    print "  --lock: lock the reconnector\n"
-    print "  --unlock: unlock the reconnector\n"
-    print "  --help or -h\n"
+    print("Usage: wifi-reconnector [--preferred \'<comma_separated_network"
+          "_names>\']\n"
+          "                        [--not_preferred \'<comma_separated_network"
+          "_names>\']\n\n"
+          "Each network name must be quoted in \"\" if it is longer than one "
+          "character.\n\n")
+    print("Additional options:\n")
+    print("  --signal_quality_deleta_threshold <1-100>: difference in signal"
+          " strength")
+    print("    percent that causes a switch between networks in the"
+          " same preference class\n")
+    print("  --signal_quality_threshold <1-100>: minimal signal"
+          " strength percent that")
+    print("    causes us disassociate from a network\n")
+    print("  --skip_scan_if_quality_above <1-100>: don't scan while connected")
+    print("    to a preferred network with a better signal strength percent")
+    print("    (default 75)\n")
+    print("  --interface <ifname>: which interface is wlan (default wlan0)\n")
+    print("  --dry_run:  don't do anything just dump what would be done.\n")
+    print("  --sleep_between_checks: seconds between checks, unset or 0 to"
+          " exit immediately.")
+    print("  --lockfile: path to lockfile. A path starting with \'/\' is")
+    print("    absolute, without it is concatenated after $HOME\n")
+    print("  --scan_timeout <seconds>: give up on scanning when all scans"
+          " together take longer (default 20)\n")
+    print("  --scan_cache_ttl <seconds>: reuse a scan this young while on a")
+    print("    preferred network, 0 to always scan (default 60)\n")
+    print("  --lock: lock the reconnector\n")
+    print("  --unlock: unlock the reconnector\n")
+    print("  --help or -h\n")
 
 
 def match_iwconfig_v30_essid(output):
@@ -195,10 +283,23 @@ def match_iwconfig_v30_essid(output):
     is presumed to be in the output format generated by iwconfig of
     version 30 or compatible
     """
-    essid_pattern = re.compile('.+\s+ESSID:\"([^\"]+)\"')
+    essid_pattern = re.compile(r'.+\s+ESSID:\"([^\"]+)\"')
+    for line in output:
+        match = essid_pattern.match(line)
+        if match:
+            return match.group(1)
+
+
+def match_iwconfig_v30_quality(output):
+    """Returns the link quality as a fraction from output, where output
+    is presumed to be in the output format generated by iwconfig of
+    version 30 or compatible. Returns None if no quality is reported.
+    """
+    quality_pattern = re.compile(r'.*Link Quality=(\d+)/(\d+)')
     for line in output:
-        if essid_pattern.match(line):
-            return essid_pattern.match(line).group(1)
+        match = quality_pattern.match(line)
+        if match:
+            return float(match.group(1)) / float(match.group(2))
 
 
 def is_locked(filename):
@@ -250,105 +351,202 @@ def print_with_timestamp(text):
     now = time.time()
     now_string = datetime.datetime.fromtimestamp(now).strftime(
         '%Y%m%d-%H:%M:%S')
-    print "%s: %s" % (now_string, text)
+    print("%s: %s" % (now_string, text))
 
 
 def run_command_or_die(command):
-    """Runs the command which is given as a list of commandline arguments.
+    """Runs the command which is given as a list of commandline arguments
+    and returns its output. Error output is passed through to our stderr.
     """
     try:
         process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        outs, errs = process.communicate()
-        if (len(errs)):
-            sys.stderr.write("Errors while executing %s:\n%s\n" % (command[0],
-                                                                   errs))
-        return outs, errs
+                                   universal_newlines=True)
+        outs = process.communicate()[0]
+        return outs
     except OSError as err:
         bail_with_message("Failed to find or execute %s." % command[0])
-    except subprocess.CalledProcessError:
-        bail_with_messsage("Program failure %s." % command[0]);
+
+
+def run_command_discarding_output_or_die(command):
+    """Runs the command which is given as a list of commandline arguments
+    without collecting its output. Error output is passed through to our
+    stderr. Returns the exit status of the command.
+    """
+    try:
+        return subprocess.call(command, stdout=subprocess.DEVNULL)
+    except OSError as err:
+        bail_with_message("Failed to find or execute %s." % command[0])
+
+
+def run_command_streaming(command, timeout=None):
+    """Runs the command which is given as a list of commandline arguments
+    and yields its output line by line as it is produced. Error output is
+    passed through to our stderr. If the command is still running after
+    timeout seconds it is killed and subprocess.TimeoutExpired is raised.
+    """
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    except OSError as err:
+        bail_with_message("Failed to find or execute %s." % command[0])
+    if timeout != None:
+        deadline = time.monotonic() + timeout
+    fd = process.stdout.fileno()
+    pending = b''
+    try:
+        while True:
+            if timeout != None:
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0 or
+                    not select.select([fd], [], [], remaining)[0]):
+                    process.kill()
+                    raise subprocess.TimeoutExpired(command, timeout)
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8', 'replace')
+        if pending:
+            yield pending.decode('utf-8', 'replace')
+    finally:
+        process.stdout.close()
+        process.wait()
 
 
 def match_iwlist_v30_output(output):
-    """Returns a dictionary of a all found wireless channels
-    parsed from the output of iwlist. The returned dicitionary is keyed on
-    the ESSID and each value for the keys is a set of parameters describing
-    the wlan. This set is a dicitionary, too with the following fields.
-
-       essid        : repeated the key for easier debugging
-       cell         : wifi cell number as they apear in the listing output
-       channel      : channel number
-       quality      : devide the returned quality_numerator by denominator
-                      into a bogus fractional representation. 
-       signal_level : negative signal attenuation measured in dB
-       address      : this is the base station MAC aka BSSID
-       frequency    : normally a function of channel but depends on geography
+    """Yields a tuple (essid, quality, frequency) for every wireless cell
+    found in the output of iwlist, in the order of the listing. The quality
+    is the quality numerator divided by the denominator, a bogus fractional
+    representation. The frequency is in GHz, 0 if iwlist doesn't show it.
 
     This function may need changes as iwlist evolves. Please change this to
     different versions and then add a function to autodetect the matcher
     that we should use.
     """
-    cell_header_pattern = re.compile(
-        '\s*Cell\s(\d+)\s.+Address: ([0-9ABCDEF:]+)')
-    channel_pattern = re.compile('\s*Channel:(\d+)')
-    freq_pattern = re.compile('\s*Frequency: ([\d\.]+)\s*GHz');
-    quality_and_siqnal_pattern = re.compile(
-        '\s*Quality=(\d+)/(\d+)\s+Signal level=-(\d+) dBm')
-    essid_pattern = re.compile('\s*ESSID:\"([^\"]+)\"');
-
-    parsed_set = { }
-    cell = -1
+    in_cell = False
     for line in output:
-        if cell_header_pattern.match(line):
-            if cell >= 0:
-                parsed_set[essid] = {'essid': essid,
-                                     'cell': cell,
-                                     'channel': channel,
-                                     'quality' : (float(quality_num) /
-                                     float(quality_denom)),
-                                     'signal_level' : signal_level,
-                                     'address' : address,
-                                     'frequency' : frequency, }
+        line = line.lstrip()
+        prefix = line[:5]
+        pattern = _IWLIST_PATTERNS.get(prefix)
+        if pattern == None:
+            continue
+        match = pattern.match(line)
+        if not match:
+            continue
+        if prefix == 'Cell ':
+            if in_cell:
+                yield essid, quality, frequency
             # Reset our description
-            cell = -1
-            channel = -1
-            quality_num = 0
-            quality_denom = 1
-            signal_level = 100
+            in_cell = True
+            essid = ''
+            quality = 0.
+            frequency = 0.
+        elif prefix == 'Frequ':
+            frequency = float(match.group('ghz'))
+        elif prefix == 'Quali':
+            quality = (float(match.group('quality_num')) /
+                       float(match.group('quality_denom')))
+        elif prefix == 'ESSID':
+            essid = match.group('essid_name')
+    # Emit the last-scanned cell, too
+    if in_cell:
+        yield essid, quality, frequency
+
+
+def match_iw_scan_output(output):
+    """Yields a tuple (essid, quality, frequency) for every BSS found in
+    the output of iw scan, just like match_iwlist_v30_output. iw only
+    reports the signal level, the quality is derived from it the same way
+    cfg80211 does for iwlist.
+    """
+    in_bss = False
+    for line in output:
+        match = _IW_LINE_RE.match(line.lstrip())
+        if not match:
+            continue
+        kind = match.lastgroup
+        if kind == 'bss':
+            if in_bss:
+                yield essid, quality, frequency
+            in_bss = True
             essid = ''
-            address = ''
-            frequency = 0
-            match = cell_header_pattern.match(line)
-            cell = int(match.group(1))
-            address = match.group(2)
-        elif channel_pattern.match(line):
-            match = channel_pattern.match(line)
-            channel = int(match.group(1))
-        elif freq_pattern.match(line):
-            match = freq_pattern.match(line)
-            frequency = float(match.group(1))
-        elif quality_and_siqnal_pattern.match(line):
-            match = quality_and_siqnal_pattern.match(line)
-            quality_num = match.group(1)
-            quality_denom = match.group(2)
-            signal_level = match.group(3)
-        elif essid_pattern.match(line):
-            essid = essid_pattern.match(line).group(1)
-    # Enter the last-scanned item into our dictionary before
-    # we return
-    if cell >= 0:
-        parsed_set[essid] = {'essid': essid,
-                             'cell': cell,
-                             'channel': channel,
-                             'quality' : (float(quality_num) /
-                                          float(quality_denom)),
-                             'signal_level' : signal_level,
-                             'address' : address,
-                             'frequency' : frequency,
-        }
-
-    return parsed_set
+            quality = 0.
+            frequency = 0.
+        elif not in_bss:
+            continue
+        elif kind == 'frequency':
+            frequency = float(match.group('mhz')) / 1000.
+        elif kind == 'signal':
+            attenuation = float(match.group('attenuation'))
+            quality = (min(max(110. - attenuation, 0.), LINK_QUALITY_MAX) /
+                       LINK_QUALITY_MAX)
+        elif kind == 'ssid':
+            essid = match.group('ssid_name')
+    if in_bss:
+        yield essid, quality, frequency
+
+
+def match_nmcli_wifi_list(output):
+    """Yields a tuple (essid, quality, frequency) for every access point in
+    the terse output of nmcli device wifi list with the fields SIGNAL, FREQ
+    and SSID, just like match_iwlist_v30_output. The quality is the signal
+    strength percent NetworkManager reports.
+    """
+    for line in output:
+        fields = line.split(':', 2)
+        if len(fields) != 3:
+            continue
+        signal, frequency, essid = fields
+        # Only the SSID, which comes last, can contain escaped characters
+        essid = re.sub(r'\\(.)', r'\1', essid)
+        if not essid or not signal.isdigit():
+            continue
+        megahertz = frequency.split()
+        if megahertz and megahertz[0].isdigit():
+            frequency = float(megahertz[0]) / 1000.
+        else:
+            frequency = 0.
+        yield essid, float(signal) / 100., frequency
+
+
+def collect_wlans(cells, wanted):
+    """Returns the WLANs among cells, which are (essid, quality, frequency)
+    tuples, whose ESSID is in wanted. The result is a triple of parallel
+    arrays (essids, qualities, frequencies). A WLAN seen in several cells is
+    listed once with the best quality.
+    """
+    essids = []
+    qualities = array.array('d')
+    frequencies = array.array('d')
+    for essid, quality, frequency in cells:
+        if not essid in wanted:
+            continue
+        if essid in essids:
+            index = essids.index(essid)
+            if quality <= qualities[index]:
+                continue
+            qualities[index] = quality
+            frequencies[index] = frequency
+            continue
+        essids.append(essid)
+        qualities.append(quality)
+        frequencies.append(frequency)
+    return essids, qualities, frequencies
+
+
+def split_wlan_names(value):
+    """Returns the list of network names in value, a comma separated list
+    of names. Commas inside double quotes are kept since a network name
+    may contain a comma. Raises ValueError on an unbalanced quote.
+    """
+    lexer = shlex.shlex(value, posix=True)
+    lexer.whitespace = ','
+    lexer.whitespace_split = True
+    lexer.quotes = '"'
+    lexer.escape = ''
+    lexer.commenters = ''
+    return list(lexer)
 
 
 def parse_commandline_args():
@@ -359,10 +557,15 @@ def parse_commandline_args():
     global interface
     global lock
     global lockfile
+    global non_preferred_wlan_set
     global non_preferred_wlans
+    global preferred_wlan_set
     global preferred_wlans
+    global scan_cache_ttl
+    global scan_timeout
     global signal_quality_delta_threshold
     global signal_quality_threshold
+    global skip_scan_quality_threshold
     global sleep_between_checks
     global unlock
 
@@ -371,10 +574,13 @@ def parse_commandline_args():
                                    "h", ["help",
                                          "signal_quality_threshold=",
                                          "signal_quality_delta_threshold=",
+                                         "skip_scan_if_quality_above=",
                                          "sleep_between_checks=",
                                          "preferred=",
                                          "not_preferred=",
                                          "lockfile=",
+                                         "scan_cache_ttl=",
+                                         "scan_timeout=",
                                          "dry_run",
                                          "lock",
                                          "unlock"])
@@ -386,6 +592,10 @@ def parse_commandline_args():
                 lockfile = value
             if option == "--sleep_between_checks":
                 sleep_between_checks = int(value)
+            if option == "--scan_cache_ttl":
+                scan_cache_ttl = int(value)
+            if option == "--scan_timeout":
+                scan_timeout = int(value)
             if option == "--lock":
                 lock = True
             if option == "--unlock":
@@ -404,18 +614,26 @@ def parse_commandline_args():
                     bail_with_message(
                         "--signal_quality_threshold should be in"\
                         " 1-100 range")
-            if option == "--preferred":
-                # we use the csv reader to preserve commas in quotes, what
-                # if the network name contains a comma
-                for parsed in csv.reader([value], delimiter=',', quotechar='"'):
-                    preferred_wlans = parsed
-            if option == "--not_preferred":
-                for parsed in csv.reader([value], delimiter=',', quotechar='"'):
-                    non_preferred_wlans = parsed
+            if option == "--skip_scan_if_quality_above":
+                skip_scan_quality_threshold = int(value) / 100.
+                if (skip_scan_quality_threshold < 0.01 or
+                    skip_scan_quality_threshold > 1.):
+                    bail_with_message(
+                        "--skip_scan_if_quality_above should be in"\
+                        " 1-100 range")
+            try:
+                if option == "--preferred":
+                    preferred_wlans = split_wlan_names(value)
+                if option == "--not_preferred":
+                    non_preferred_wlans = split_wlan_names(value)
+            except ValueError as err:
+                bail_with_message("%s: %s" % (option, err))
             if option == "--interface":
                 interface = value
             if option == "--dry_run":
                 dry_run = True
+        preferred_wlan_set = frozenset(preferred_wlans)
+        non_preferred_wlan_set = frozenset(non_preferred_wlans)
 
     except getopt.GetoptError as err:
         print_with_timestamp(str(err))
@@ -423,109 +641,389 @@ def parse_commandline_args():
         sys.exit(-1)
 
 
-def scan_wifi(wlans):
-    """Runs iwlist on all of the provided wlans. This allows picking up
-    attributes of hidden wlans as well as those that are visible. For each
-    detected WLAN we parse the iwlist output to get an indexed representation
-    of our WLAN parameters.
+def time_left(deadline):
+    """Returns the seconds left until deadline, a time.monotonic() value,
+    but not less than 0.
+    """
+    return max(deadline - time.monotonic(), 0)
+
+
+def is_usable_scan(scanned, required_wlan):
+    """Returns true if scanned, in the format of collect_wlans, found any
+    WLAN at all and required_wlan unless that is None.
+    """
+    essids = scanned[0]
+    return bool(essids) and (required_wlan == None or required_wlan in essids)
+
+
+def scan_wifi(wlans, required_wlan=None):
+    """Scans the interface and returns the detected WLANs that are either in
+    wlans, in the non-preferred WLANs or required_wlan in the format of
+    collect_wlans.
+
+    NetworkManager scans on its own, so we first ask it for the access
+    points it knows about, without letting it rescan. If that finds none of
+    the WLANs, or not required_wlan, e.g., because NetworkManager isn't
+    running or its nmcli doesn't know --rescan, we scan ourselves.
+
+    If we know from earlier scans on which frequencies these WLANs are, iw
+    scans only those frequencies. Scanning every channel takes a lot longer.
+    If that finds none of the WLANs, or not required_wlan, or if the last
+    scan of all channels is older than FULL_SCAN_INTERVAL, we fall back to
+    a single iwlist scan of all channels. We remember the frequencies seen
+    by any of these scans.
+
+    Raises subprocess.TimeoutExpired if scanning takes longer than the scan
+    timeout in total. If only the NetworkManager listing times out we still
+    scan ourselves in the time that is left.
     """
     global interface
-    for wlan in wlans:
-        command = [ IWLIST, interface, SCANNING_COMMAND, 'essid', wlan]
-        outs, errs = run_command_or_die(command)
-        return match_iwlist_v30_output(outs.split('\n'))
+    global non_preferred_wlan_set
+    global scan_timeout
+    deadline = time.monotonic() + scan_timeout
+    wanted = non_preferred_wlan_set.union(wlans)
+    # find_better_wifi needs the quality of the active WLAN, listed or not
+    if required_wlan != None:
+        wanted = wanted.union([required_wlan])
+    known_frequencies, last_full_scan = load_known_frequencies(
+        FREQUENCY_CACHE_FILE)
+    if os.access(NMCLI, os.X_OK):
+        command = [ NMCLI, '-t', '-f', 'SIGNAL,FREQ,SSID', 'device', 'wifi',
+                    'list', 'ifname', interface, '--rescan', 'no']
+        try:
+            scanned = collect_wlans(
+                match_nmcli_wifi_list(run_command_streaming(
+                    command, min(time_left(deadline), NMCLI_LIST_TIMEOUT))),
+                wanted)
+        except subprocess.TimeoutExpired as err:
+            sys.stderr.write("%s\n" % err)
+            scanned = ([], None, None)
+        if is_usable_scan(scanned, required_wlan):
+            if learn_frequencies(scanned, known_frequencies):
+                save_known_frequencies(FREQUENCY_CACHE_FILE,
+                                       known_frequencies, last_full_scan)
+            return scanned
+
+    frequencies = sorted(set(known_frequencies[essid] for essid in wanted
+                             if known_frequencies.get(essid)))
+    if (frequencies and os.access(IW, os.X_OK) and
+        time.time() - last_full_scan < FULL_SCAN_INTERVAL):
+        command = [ IW, 'dev', interface, 'scan', 'freq']
+        command += ['%d' % round(frequency * 1000)
+                    for frequency in frequencies]
+        scanned = collect_wlans(
+            match_iw_scan_output(run_command_streaming(
+                command, time_left(deadline))),
+            wanted)
+        if is_usable_scan(scanned, required_wlan):
+            if learn_frequencies(scanned, known_frequencies):
+                save_known_frequencies(FREQUENCY_CACHE_FILE,
+                                       known_frequencies, last_full_scan)
+            return scanned
+
+    command = [ IWLIST, interface, SCANNING_COMMAND]
+    scanned = collect_wlans(
+        match_iwlist_v30_output(run_command_streaming(
+            command, time_left(deadline))),
+        wanted)
+    learn_frequencies(scanned, known_frequencies)
+    save_known_frequencies(FREQUENCY_CACHE_FILE, known_frequencies,
+                           time.time())
+    return scanned
+
+
+def learn_frequencies(scanned, known_frequencies):
+    """Adds the frequencies of the WLANs in scanned, in the format of
+    collect_wlans, to known_frequencies. Returns true if that changed
+    known_frequencies.
+    """
+    essids, frequencies = scanned[0], scanned[2]
+    changed = False
+    for essid, frequency in zip(essids, frequencies):
+        if frequency and known_frequencies.get(essid) != frequency:
+            known_frequencies[essid] = frequency
+            changed = True
+    return changed
+
+
+def open_own_file(filename):
+    """Opens filename for reading without following symlinks and returns
+    the file together with its os.stat result. Raises OSError unless it is
+    a regular file owned by us, so others can't plant what we read.
+    """
+    fd = os.open(filename, os.O_RDONLY | os.O_NOFOLLOW)
+    info = os.fstat(fd)
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != os.geteuid():
+        os.close(fd)
+        raise OSError(errno.EPERM, "Not a regular file of ours", filename)
+    return os.fdopen(fd), info
+
+
+def write_file_replacing(filename, text):
+    """Writes text to a new file next to filename and moves it in place of
+    filename. Whatever filename was before, e.g., a symlink planted in
+    /tmp, is replaced rather than written through.
+    """
+    directory, name = os.path.split(filename)
+    fd, temporary = tempfile.mkstemp(prefix='.' + name, dir=directory or '.')
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(text)
+        os.replace(temporary, filename)
+    except OSError:
+        os.remove(temporary)
+        raise
+
+
+def load_known_frequencies(filename):
+    """Returns the pair of the frequencies in GHz keyed on the ESSID and the
+    time of the last full scan stored in filename. Returns an empty
+    dictionary and 0 if there is no such file or if it cannot be read.
+    """
+    try:
+        file = open_own_file(filename)[0]
+        with file:
+            stored = json.load(file)
+        return dict(stored['frequencies']), float(stored['full_scan'])
+    except (IOError, OSError, KeyError, TypeError, ValueError):
+        return { }, 0.
+
+
+def save_known_frequencies(filename, frequencies, last_full_scan):
+    """Stores the frequencies keyed on the ESSID and the time of the last
+    full scan in filename so that later runs can reuse them via
+    load_known_frequencies.
+    """
+    try:
+        write_file_replacing(filename, json.dumps(
+            {'frequencies': frequencies, 'full_scan': last_full_scan}))
+    except (IOError, OSError) as err:
+        # Not running as root, we'll do without
+        if err.errno in (errno.EACCES, errno.EPERM):
+            return
+        sys.stderr.write("Failed to write frequency cache %s: %s\n" %
+                         (filename, err.strerror))
+
+
+def load_cached_scan(filename, max_age, required_wlan=None):
+    """Returns the scan result stored in filename if the file was written
+    less than max_age seconds ago. Returns None if there is no such file,
+    if it is too old, if it cannot be read or if the scan didn't see
+    required_wlan, e.g., because we have switched WLANs since.
+    """
+    try:
+        file, info = open_own_file(filename)
+        with file:
+            if time.time() - info.st_mtime > max_age:
+                return None
+            essids, qualities, frequencies = json.load(file)
+        scanned = (essids, array.array('d', qualities),
+                   array.array('d', frequencies))
+    except (IOError, OSError, TypeError, ValueError):
+        return None
+    if not is_usable_scan(scanned, required_wlan):
+        return None
+    return scanned
+
+
+def save_cached_scan(filename, scanned_wifi):
+    """Stores the scan result scanned_wifi in filename so that later
+    runs can reuse it via load_cached_scan.
+    """
+    essids, qualities, frequencies = scanned_wifi
+    try:
+        write_file_replacing(filename, json.dumps(
+            [essids, qualities.tolist(), frequencies.tolist()]))
+    except (IOError, OSError) as err:
+        sys.stderr.write("Failed to write scan cache %s: %s\n" %
+                         (filename, err.strerror))
+
+
+def invalidate_cached_scan(filename):
+    """Removes a stored scan result, e.g., after we switched networks
+    """
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def read_proc_wireless(iface):
+    """Returns the link quality, signal level and noise level of iface as
+    a triple of floats read from /proc/net/wireless. Returns None if iface
+    is not listed there.
+    """
+    with open(PROC_NET_WIRELESS) as file:
+        for line in file:
+            name, sep, stats = line.partition(':')
+            if sep and name.strip() == iface:
+                fields = stats.split()
+                return (float(fields[1]), float(fields[2]),
+                        float(fields[3]))
+    return None
+
+
+def iw_point_ioctl(iface, request_number, size):
+    """Carries out the wireless extensions ioctl request_number on iface
+    with a buffer of size bytes and returns the bytes the kernel filled
+    in. Raises IOError or OSError if the ioctl cannot be carried out.
+    """
+    buffer = ctypes.create_string_buffer(size)
+    # struct iwreq: the interface name followed by a struct iw_point
+    request = struct.pack('16sPHH', iface.encode(),
+                          ctypes.addressof(buffer), size, 0)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        result = fcntl.ioctl(sock.fileno(), request_number, request)
+    finally:
+        sock.close()
+    length = struct.unpack('16sPHH', result)[2]
+    return buffer.raw[:length]
+
+
+def read_essid_ioctl(iface):
+    """Returns the ESSID iface is configured for by asking the kernel via
+    the SIOCGIWESSID ioctl, or None if there is none. Raises IOError or
+    OSError if the ioctl cannot be carried out.
+    """
+    essid = iw_point_ioctl(iface, SIOCGIWESSID, IW_ESSID_MAX_SIZE + 1)
+    return essid.rstrip(b'\0').decode('utf-8', 'replace') or None
+
+
+def read_max_quality_ioctl(iface):
+    """Returns the maximum link quality the driver of iface reports, as
+    found in the range information of the SIOCGIWRANGE ioctl. Returns None
+    if the driver doesn't tell. Raises IOError or OSError if the ioctl
+    cannot be carried out.
+    """
+    iw_range = iw_point_ioctl(iface, SIOCGIWRANGE, IW_RANGE_BUFFER_SIZE)
+    if len(iw_range) <= IW_RANGE_MAX_QUAL_OFFSET:
+        return None
+    return float(bytearray(iw_range)[IW_RANGE_MAX_QUAL_OFFSET]) or None
+
 
-             
 def get_active_wlan():
-    """Runs iwconfig to determine the WLAN to which the interface is configured
+    """Determines the WLAN to which the interface is configured and the
+    quality of that link. Returns both as a pair, the quality is None if the
+    driver doesn't report it. The kernel is asked directly, iwconfig is run
+    only if that fails or the scale of the quality is unknown.
     """
     global interface
+    try:
+        essid = read_essid_ioctl(interface)
+        stats = read_proc_wireless(interface)
+        max_quality = read_max_quality_ioctl(interface)
+    except (IOError, OSError):
+        stats = None
+    if stats != None and max_quality != None:
+        return essid, stats[0] / max_quality
     command = [ IWCONFIG, interface]
-    outs, errs = run_command_or_die(command)
-    return match_iwconfig_v30_essid(outs.split('\n'))
+    outs = run_command_or_die(command)
+    lines = outs.split('\n')
+    return match_iwconfig_v30_essid(lines), match_iwconfig_v30_quality(lines)
 
 
-def find_better_wifi(active_wifi, scanned_wifi_set):
+def find_better_wifi(active_wifi, scanned_wifi):
     """Returns the WLAN to which the interface should be considered based
     on the parameters provided to this script on the commandline and the
-    output that we gathered from iwlist (passed as scanned_wifi_set). If
-    there is no WLAN that is better than the currently configured WLAN, then
-    the function will return the name of the current WLAN. If the current
-    WLAN looks terrible or there is logical better choice (e.g., a preferred
-    WLAN at good quality) then that WLAN's name will be returned.
+    output that we gathered from the scan (passed as scanned_wifi in the
+    format of collect_wlans). If there is no WLAN that is better than the
+    currently configured WLAN, then the function will return the name of
+    the current WLAN. If the current WLAN looks terrible or there is
+    logical better choice (e.g., a preferred WLAN at good quality) then
+    that WLAN's name will be returned.
     """
-    global preferred_wlans
-    global non_preferred_wlans
-    active_is_preferred = False
-    if scanned_wifi_set == None or len(scanned_wifi_set) == 0:
+    global preferred_wlan_set
+    global non_preferred_wlan_set
+    global signal_quality_delta_threshold
+    global signal_quality_lower_bound
+    # Local names for the flags, they are looked up in the loops below
+    preferred = preferred_wlan_set
+    non_preferred = non_preferred_wlan_set
+    lower_bound = signal_quality_lower_bound
+    delta_threshold = signal_quality_delta_threshold
+
+    if scanned_wifi == None or len(scanned_wifi[0]) == 0:
         return active_wifi
-    if active_wifi in preferred_wlans:
-        active_is_preferred = True
-    if (active_wifi in non_preferred_wlans) and active_is_preferred :
+    essids, qualities = scanned_wifi[:2]
+    active_is_preferred = active_wifi in preferred
+    if (active_wifi in non_preferred) and active_is_preferred :
         bail_with_message("%s cannot be both preferred and non-preferred" %
                           active_wifi)
-    allow_downgrade = False
     if (active_wifi == None) or (active_wifi == ""):
         bail_with_message("couln't find active wifi")
-    if not active_wifi in scanned_wifi_set:
-        bail_with_message("no iwlist info on active wifi %s", active_wifi)
-    if scanned_wifi_set[active_wifi]['quality'] < signal_quality_lower_bound :
-        allow_downgrade = True;
+    if not active_wifi in essids:
+        bail_with_message("no scan info on active wifi %s" % active_wifi)
+    active_quality = qualities[essids.index(active_wifi)]
+
+    # The strongest WLAN of sufficient quality, any preferred one beats
+    # all non-preferred ones
+    eligible = [index for index, quality in enumerate(qualities)
+                if quality >= lower_bound]
+    best = max((index for index in eligible
+                if essids[index] in preferred),
+               key=lambda index: qualities[index], default=None)
+    if best == None:
+        best = max((index for index in eligible
+                    if essids[index] in non_preferred),
+                   key=lambda index: qualities[index], default=None)
+    if best == None or essids[best] == active_wifi:
+        return active_wifi
+    if (essids[best] in preferred) != active_is_preferred:
+        # An upgrade to a preferred WLAN, or a downgrade because the
+        # preferred active WLAN is too weak
+        return essids[best]
 
-    sufficiently_better = active_wifi
-    better_quality = scanned_wifi_set[active_wifi]['quality']
-    sufficiently_better_is_preferred = active_is_preferred
+    # Within the same preference class we impose a fudge difference before
+    # switching to a different access point, unless the active one is so
+    # bad that we'd accept a downgrade.
+    fudge = 0
+    if active_quality >= lower_bound:
+        fudge = delta_threshold
+    if active_quality < qualities[best] - fudge:
+        return essids[best]
+    return active_wifi
+
+
+def activate_wifi_dbus(wifi):
+    """Asks NetworkManager via D-Bus to activate the connection named wifi
+    on the interface. Returns true if NetworkManager accepted the request,
+    false if D-Bus is unavailable or if there is no such connection.
+    """
+    global interface
+    if dbus == None:
+        return False
+    try:
+        bus = dbus.SystemBus()
+        settings = dbus.Interface(
+            bus.get_object(NM_BUS_NAME, NM_SETTINGS_PATH),
+            NM_BUS_NAME + '.Settings')
+        for path in settings.ListConnections():
+            connection = dbus.Interface(bus.get_object(NM_BUS_NAME, path),
+                                        NM_BUS_NAME + '.Settings.Connection')
+            if connection.GetSettings()['connection']['id'] != wifi:
+                continue
+            manager = dbus.Interface(bus.get_object(NM_BUS_NAME, NM_PATH),
+                                     NM_BUS_NAME)
+            device = manager.GetDeviceByIpIface(interface)
+            manager.ActivateConnection(path, device, '/')
+            return True
+    except dbus.exceptions.DBusException as err:
+        sys.stderr.write("D-Bus activation of %s failed: %s\n" % (wifi, err))
+    return False
 
-    for wifi in preferred_wlans:
-        if not wifi in scanned_wifi_set:
-            continue
-        upgrade_wifi_quality = scanned_wifi_set[wifi]['quality']
-        if upgrade_wifi_quality < signal_quality_lower_bound:
-            continue
-        if not active_is_preferred:
-            sufficiently_better = wifi
-            better_quality = upgrade_wifi_quality
-            continue
-        # if the currently active wifi is still the best choice and
-        # if it is not so bad that we'd accept a downgrade, we
-        # impose a fudge difference before switching to a different
-        # access point.
-        if (sufficiently_better == active_wifi) :
-            if not allow_downgrade:
-                fudge = signal_quality_delta_threshold
-        else:
-            fudge = 0
-        if (sufficiently_better < upgrade_wifi_quality - fudge) :
-            sufficiently_better = wifi
-            better_quality = upgrade_wifi_quality
-
-    # if we leave the first loop with a network that has signal quality above
-    # our cut-off and the wlan is preferred then we're done. Don't scane
-    # for a non-preferred option
-    if sufficiently_better_is_preferred and (better_quality >
-                                             signal_quality_lower_bound) :
-        return sufficiently_better
-
-    for wifi in non_preferred_wlans:
-        upgrade_wifi_quality = scanned_wifi_set[wifi]['quality']
-        if upgrade_wifi_quality < signal_quality_lower_bound:
-            continue
-        if (sufficiently_better == active_wifi) :
-            fudge = signal_quality_delta_threshold
-        else:
-            fudge = 0
-        if (sufficiently_better < upgrade_wifi_quality - fudge) :
-            sufficiently_better = wifi
-            better_quality = upgrade_wifi_quality
-    return sufficiently_better
 
-    
 def activate_wifi(wifi):
     """Contacts NetworkManager to change WLAN association to the WLAN given
     as wifi. This function does not check if we're already connected to wifi.
+    We talk to NetworkManager via D-Bus and only run nmcli if that fails.
     """
+    if activate_wifi_dbus(wifi):
+        return
     command = (NMCLI, 'c', 'up', 'id', wifi)
-    outs, errs = run_command_or_die(command)
+    status = run_command_discarding_output_or_die(command)
+    if status != 0:
+        sys.stderr.write("%s exited with status %d\n" % (command[0], status))
 
 
 def get_path_full_or_relative_to_home(filename):
@@ -564,9 +1062,13 @@ def process_prescan_commands():
         bail_with_message("--lock and --unlock require a lockfile")
 
     fullpath = get_path_full_or_relative_to_home(lockfile)
+    # do_lock bails if it fails, so after it we know we're locked. Otherwise
+    # look at the filesystem, do_unlock doesn't tell whether it worked.
+    locked = None
     if lock:
         if not dry_run:
             do_lock(fullpath)
+            locked = True
         else:
             print_with_timestamp("do_lock(%s)" % fullpath)
     if unlock:
@@ -574,8 +1076,10 @@ def process_prescan_commands():
             do_unlock(fullpath)
         else:
             print_with_timestamp("do_unlock(%s)" % fullpath)
-            
-    if is_locked(fullpath):
+
+    if locked == None:
+        locked = is_locked(fullpath)
+    if locked:
         print_with_timestamp("Reconnect is locked via %s" % fullpath)
         return True
     return False
@@ -584,7 +1088,11 @@ def process_prescan_commands():
 def main():
     global dry_run
     global non_preferred_wlans
+    global preferred_wlan_set
     global preferred_wlans
+    global scan_cache_ttl
+    global signal_quality_lower_bound
+    global skip_scan_quality_threshold
     global sleep_between_checks
 
     parse_commandline_args()
@@ -596,9 +1104,33 @@ def main():
             time.sleep(sleep_between_checks)
             continue  # we already did work
 
-        scanned_wifi = scan_wifi(preferred_wlans)
-        active_wifi = get_active_wlan()
-        better_wifi = find_better_wifi(active_wifi, scanned_wifi)
+        active_wifi, active_quality = get_active_wlan()
+        if (active_wifi in preferred_wlan_set and active_quality != None and
+            active_quality > skip_scan_quality_threshold):
+            # Good enough on a preferred network, don't bother scanning
+            better_wifi = active_wifi
+        else:
+            # Scanning takes seconds and disturbs the radio. While we're on a
+            # preferred network above the lower bound, a recent scan that saw
+            # it will do.
+            scanned_wifi = None
+            if (active_wifi in preferred_wlan_set and active_quality != None
+                and active_quality >= signal_quality_lower_bound
+                and scan_cache_ttl > 0):
+                scanned_wifi = load_cached_scan(SCAN_CACHE_FILE,
+                                                scan_cache_ttl, active_wifi)
+            if scanned_wifi == None:
+                try:
+                    scanned_wifi = scan_wifi(preferred_wlans, active_wifi)
+                    save_cached_scan(SCAN_CACHE_FILE, scanned_wifi)
+                except subprocess.TimeoutExpired as err:
+                    # Without a recent scan that saw the active WLAN we stay
+                    # where we are
+                    print_with_timestamp("Scan timed out: %s" % err)
+                    scanned_wifi = load_cached_scan(SCAN_CACHE_FILE,
+                                                    scan_cache_ttl,
+                                                    active_wifi)
+            better_wifi = find_better_wifi(active_wifi, scanned_wifi)
 
         if not (better_wifi == active_wifi):
             if not dry_run:
@@ -606,6 +1138,7 @@ def main():
                     "Switching active wifi %s -> %s "
                     % (active_wifi, better_wifi))
                 activate_wifi(better_wifi)
+                invalidate_cached_scan(SCAN_CACHE_FILE)
             else:
                 print_with_timestamp("activate_wifi(%s)" % better_wifi)
         else:
@@ -613,7 +1146,7 @@ def main():
         if (sleep_between_checks == 0):
             break
         time.sleep(sleep_between_checks)
-    print "exit wifi check loop"
+    print("exit wifi check loop")
 
 if __name__ == "__main__":
     main()